@@ -3,8 +3,17 @@ import pandas as pd
 import datetime
 import altair as alt
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.oauth2 import service_account
+import google.auth
 import uuid # 雖然不再生成，但保留 import 以防未來需要
 import os # 導入 os 庫用於環境變數檢查
+import json
+import ast
+import threading
+import random
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- 0. 配置與變數 ---
 DEFAULT_BG_COLOR = "#f8f9fa"
@@ -12,17 +21,29 @@ RECORD_COLLECTION_NAME = "records"       # 交易紀錄 Collection 名稱
 BALANCE_COLLECTION_NAME = "account_status" # 餘額 Collection 名稱
 BALANCE_DOC_ID = "current_balance"       # 餘額文件 ID，固定單一文件
 BANK_ACCOUNTS_COLLECTION_NAME = "bank_accounts" # 銀行帳戶 Collection 名稱
+RECORDS_META_DOC_ID = "records_meta"     # 交易紀錄版本文件 ID (每次寫入遞增，用於快取失效)
+AGGREGATES_COLLECTION_NAME = "monthly_aggregates" # 每月彙總 Collection 名稱 (文件 ID 為 YYYY-MM)
+FIRESTORE_POOL_SIZE = 4                  # Firestore 客戶端數量 (各自擁有獨立的 gRPC 通道)
+WRITE_BATCH_SIZE = 400                   # 批次新增/刪除時每個 WriteBatch 的紀錄筆數 (Firestore 上限 500 次寫入)
+RECORDS_TABLE_LIMIT = 500                # 紀錄列表每頁筆數 (伺服器端 limit，按「載入更多」逐頁加大)
 
-# 定義交易類別
+# 定義交易類別 (不可變 tuple，重跑時直接作為選項使用)
 CATEGORIES = {
-    '收入': ['薪資', '投資收益', '禮金', '其他收入'],
-    '支出': ['餐飲', '交通', '購物', '娛樂', '房租/貸款', '教育', '醫療', '其他支出']
+    '收入': ('薪資', '投資收益', '禮金', '其他收入'),
+    '支出': ('餐飲', '交通', '購物', '娛樂', '房租/貸款', '教育', '醫療', '其他支出')
 }
+RECORD_TYPE_OPTIONS = ('支出', '收入')
+NEW_CATEGORY_OPTION = "⚙️ 新增自訂支出類別..."
+
+# 預設支付方式 (固定不變，於模組載入時建立一次)
+DEFAULT_PAYMENT_METHODS = ['現金', '信用卡', '悠遊卡']
+
+# 首頁快速記帳的類別選項
+QUICK_ENTRY_CATEGORIES = ("食", "衣", "住", "行", "育樂", "其他")
 
 # --- 1. Streamlit 介面設定 ---
-def set_ui_styles():
-    """注入客製化 CSS，設定字體、簡約背景色和排版"""
-    css = f"""
+# 客製化 CSS：DEFAULT_BG_COLOR 為常數，於模組載入時渲染一次
+APP_CSS = f"""
         <style>
         @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap');
         html, body, [class*="st-"] {{
@@ -120,10 +141,42 @@ def set_ui_styles():
         }}
         /* --- 📌 結束 --- */
         </style>
-    """
-    st.markdown(css, unsafe_allow_html=True)
+"""
+
+def set_ui_styles():
+    """注入客製化 CSS，設定字體、簡約背景色和排版 (CSS 字串已於模組載入時組好)"""
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # --- 2. Firestore 連線與初始化 ---
+def parse_credentials_info(raw):
+    """解析 secrets 中的憑證配置 (dict 或 JSON 字串)，不使用 eval"""
+    if not isinstance(raw, str):
+        return dict(raw)
+    try:
+        return json.loads(raw)
+    except ValueError:
+        # 備援：接受 Python dict 字面值 (例如單引號格式)，但只解析字面值
+        return ast.literal_eval(raw)
+
+@st.cache_resource
+def get_service_account_credentials():
+    """
+    由 secrets 建立服務帳戶憑證物件並快取 (只解析一次 JSON 與 RSA 私鑰)
+    - 客戶端池重建時直接重用同一個憑證物件與簽章器
+    - 未設定 secrets 時返回 None，改用環境預設憑證
+    """
+    if "firestore" not in st.secrets:
+        return None
+    creds_info = parse_credentials_info(st.secrets["firestore"])
+    if "project_id" not in creds_info or not creds_info["project_id"]:
+         raise ValueError("Firestore 配置錯誤：secrets 中的 'project_id' 缺失或為空。")
+    return service_account.Credentials.from_service_account_info(creds_info)
+
+@st.cache_resource
+def get_default_credentials():
+    """解析一次環境預設憑證 (ADC) 並快取，返回 (credentials, project_id)；所有客戶端共用，避免重複查詢中繼資料伺服器"""
+    return google.auth.default()
+
 @st.cache_resource
 def get_user_id() -> str:
     """獲取用戶 ID。直接返回硬編碼的固定 ID。"""
@@ -134,23 +187,29 @@ def get_user_id() -> str:
     return fixed_id
 
 @st.cache_resource
-def get_firestore_client():
-    """初始化 Firestore 客戶端，優先使用 secrets，並包含詳細錯誤提示"""
+def get_firestore_client_pool() -> list:
+    """
+    初始化 Firestore 客戶端池 (FIRESTORE_POOL_SIZE 個)，優先使用 secrets，並包含詳細錯誤提示
+    - 多個客戶端使用各自的 gRPC 通道，並行請求時避免單一通道的隊頭阻塞
+    """
     try:
-        if "firestore" in st.secrets:
-            # 優先使用 secrets.toml 中的 [firestore] 配置
-            creds_info = st.secrets["firestore"]
-            if "project_id" not in creds_info or not creds_info["project_id"]:
-                 raise ValueError("Firestore 配置錯誤：secrets 中的 'project_id' 缺失或為空。")
-            db = firestore.Client.from_service_account_info(creds_info)
-            return db
+        credentials = get_service_account_credentials()
+        if credentials is not None:
+            # 優先使用 secrets.toml 中的 [firestore] 配置 (憑證物件已快取，所有客戶端共用)
+            return [
+                firestore.Client(project=credentials.project_id, credentials=credentials)
+                for _ in range(FIRESTORE_POOL_SIZE)
+            ]
         else:
             # 如果沒有 secrets，則嘗試從環境變數初始化 (用於本地 gcloud auth)
             st.warning("⚠️ 未在 secrets.toml 中找到 'firestore' 配置，嘗試使用環境預設憑證...")
-            db = firestore.Client()
             # 嘗試讀取一個文檔以確認連線和 Project ID (可選，確認權限)
             # db.collection(BALANCE_COLLECTION_NAME).document("--test--").get()
-            return db
+            default_credentials, default_project = get_default_credentials()
+            return [
+                firestore.Client(project=default_project, credentials=default_credentials)
+                for _ in range(FIRESTORE_POOL_SIZE)
+            ]
 
     except Exception as e:
         st.error("🚨 Firestore 初始化失敗！")
@@ -166,7 +225,14 @@ def get_firestore_client():
             * **檢查 `secrets.toml` 格式:** 確保 `private_key` 使用 `'''` 
         """)
         st.stop() # 初始化失敗時停止應用程式
+        return []
+
+def get_firestore_client():
+    """從客戶端池中隨機取得一個 Firestore 客戶端"""
+    pool = get_firestore_client_pool()
+    if not pool:
         return None
+    return pool[random.randrange(len(pool))]
 
 # 初始化放在頂層，確保所有函數都能訪問
 try:
@@ -227,9 +293,24 @@ def get_bank_accounts_ref(db: firestore.Client, user_id: str):
     # 將銀行帳戶存在 users/{user_id}/account_status/bank_accounts 文件中
     return db.collection('users').document(user_id).collection(BALANCE_COLLECTION_NAME).document(BANK_ACCOUNTS_COLLECTION_NAME)
 
+def get_monthly_aggregates_ref(db: firestore.Client, user_id: str):
+    """獲取用戶每月彙總的 Collection 參考"""
+    return db.collection('users').document(user_id).collection(AGGREGATES_COLLECTION_NAME)
+
+def get_monthly_aggregate_ref(db: firestore.Client, user_id: str, month_str: str):
+    """獲取用戶某月份 (YYYY-MM) 彙總的 Document 參考"""
+    return get_monthly_aggregates_ref(db, user_id).document(month_str)
+
+def get_records_meta_ref(db: firestore.Client, user_id: str):
+    """獲取用戶交易紀錄版本的 Document 參考"""
+    return db.collection('users').document(user_id).collection(BALANCE_COLLECTION_NAME).document(RECORDS_META_DOC_ID)
+
 
 # --- 4. 數據操作函數 ---
-@st.cache_data(ttl=60, hash_funcs={firestore.Client: id}) # 緩存餘額數據 60 秒
+# 客戶端池中的客戶端皆指向同一專案，快取以專案 ID 作為鍵，避免因取到不同客戶端而重複讀取
+CLIENT_HASH_FUNCS = {firestore.Client: lambda client: client.project}
+
+@st.cache_data(ttl=60, hash_funcs=CLIENT_HASH_FUNCS) # 緩存餘額數據 60 秒
 def get_current_balance(db: firestore.Client, user_id: str) -> float:
     """從 Firestore 獲取當前總餘額"""
     if db is None: return 0.0 # 如果 db 未初始化
@@ -258,191 +339,654 @@ def set_balance(db: firestore.Client, user_id: str, new_balance: float):
     except Exception as e:
         st.error(f"❌ 更新餘額失敗: {e}")
 
-def update_balance_transactional(db: firestore.Client, user_id: str, amount: float, operation: str):
-    """使用 Transaction 更新 Firestore 中的餘額"""
-    if db is None: return
-    balance_ref = get_balance_ref(db, user_id)
+def stage_balance_change(batch, db: firestore.Client, user_id: str, amount_change: float):
+    """在 WriteBatch 中加入餘額的原子增減 (firestore.Increment，無需先讀取目前餘額)"""
+    batch.set(
+        get_balance_ref(db, user_id),
+        {'balance': firestore.Increment(amount_change), 'last_updated': firestore.SERVER_TIMESTAMP},
+        merge=True
+    )
 
-    @firestore.transactional
-    def transaction_update(transaction, ref, amount_change):
-        snapshot = ref.get(transaction=transaction)
-        current_balance = snapshot.to_dict().get('balance', 0.0) if snapshot.exists else 0.0
-        new_balance = current_balance + amount_change
-        transaction.set(ref, {'balance': new_balance, 'last_updated': datetime.datetime.now()})
-        return new_balance
+def stage_bank_account_changes(batch, db: firestore.Client, user_id: str, changes: dict):
+    """
+    在 WriteBatch 中加入多個帳戶餘額的原子增減
+    - changes: {account_id: (account_name, delta)}；帳戶不存在時會以該名稱建立，餘額從 0 開始
+    - 只更新各帳戶的 name/balance 欄位 (merge)，不覆寫整份帳戶清單
+    """
+    if not changes: return
+    batch.set(
+        get_bank_accounts_ref(db, user_id),
+        {
+            'accounts': {
+                account_id: {'name': account_name, 'balance': firestore.Increment(float(delta))}
+                for account_id, (account_name, delta) in changes.items()
+            },
+            'last_updated': datetime.datetime.now(),
+        },
+        merge=True
+    )
 
-    try:
-        transaction = db.transaction()
-        amount_change = amount if operation == 'add' else -amount
-        transaction_update(transaction, balance_ref, amount_change)
-        # 更新成功後清除相關快取
-        get_current_balance.clear()
-        get_all_records.clear() # 餘額變動，交易紀錄的快取也應清除
-    except Exception as e:
-        st.error(f"❌ 更新餘額時發生錯誤: {e}")
 
+# 交易紀錄 DataFrame 的欄位
+RECORD_COLUMNS = ['id', 'date', 'type', 'category', 'amount', 'note', 'timestamp']
+
+# 'type' 欄位使用固定類別的 Categorical，比較與 groupby 直接使用整數代碼
+RECORD_TYPE_DTYPE = pd.CategoricalDtype(['收入', '支出'])
 
-# 📌 修正：加入了 hash_funcs={firestore.Client: id} (修復 UnhashableParamError)
-@st.cache_data(ttl=60, hash_funcs={firestore.Client: id}) # 緩存交易紀錄 60 秒
-def get_all_records(db: firestore.Client, user_id: str) -> pd.DataFrame:
+# 重建每月彙總時只需要的紀錄欄位 (投影查詢)
+AGGREGATE_SOURCE_FIELDS = ('date', 'type', 'category', 'amount')
+
+# 'date' 範圍查詢的下界：Firestore 依型別排序 (Timestamp 在字串之前)，加上此條件只會匹配 Timestamp 值
+EARLIEST_RECORD_DATE = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def records_to_dataframe(docs) -> pd.DataFrame:
     """
-    從 Firestore 獲取用戶的所有交易紀錄 (強健版本)
+    將 Firestore 文件轉換為交易紀錄 DataFrame (強健版本)
     - 優先使用 'date' 欄位
     - 如果 'date' 缺失或無效，自動使用 'timestamp' 欄位作為備援
+    - 逐欄收集原始值後一次建立 DataFrame；日期由 pandas 向量化解析，不逐列判斷型別
+    """
+    ids, raw_dates, raw_timestamps, types, categories, raw_amounts, notes, account_ids, account_names = ([] for _ in range(9))
+
+    for doc in docs:
+        doc_data = doc.to_dict() or {}
+        ids.append(doc.id)
+        raw_dates.append(doc_data.get('date'))
+        raw_timestamps.append(doc_data.get('timestamp'))
+        types.append(str(doc_data.get('type')))
+        categories.append(aggregate_category_key(doc_data.get('category'))) # 與每月彙總使用相同的類別鍵
+        raw_amounts.append(doc_data.get('amount'))
+        notes.append(str(doc_data.get('note')))
+        account_ids.append(doc_data.get('account_id'))
+        account_names.append(doc_data.get('account_name'))
+
+    # Firestore Timestamp 已是 datetime；舊格式為 'YYYY-MM-DD' 字串。全部視為 UTC → 去除時區，避免 tz-aware / tz-naive 混用
+    timestamps = pd.to_datetime(pd.Series(raw_timestamps, dtype=object), errors='coerce', utc=True, format='mixed').dt.tz_convert(None)
+    dates = pd.to_datetime(pd.Series(raw_dates, dtype=object), errors='coerce', utc=True, format='mixed').dt.tz_convert(None)
+    # 交易日期以 UTC 日期為準；'date' 缺失或無效時以 'timestamp' 備援
+    parsed_dates = pd.DatetimeIndex(dates.dt.floor('D').fillna(timestamps))
+    # 金額向量化轉換 (與 safe_float 相同規則：無法轉換的字串先去除逗號與空白再試，仍失敗則為 0)
+    amount_values = pd.Series(raw_amounts, dtype=object)
+    amounts = pd.to_numeric(amount_values, errors='coerce')
+    retry = amounts.isna() & amount_values.notna()
+    if retry.any():
+        amounts[retry] = pd.to_numeric(amount_values[retry].astype(str).str.replace(',', '').str.strip(), errors='coerce')
+    amounts = amounts.fillna(0.0)
+    return pd.DataFrame({
+        'id': pd.array(ids, dtype=object),
+        'date': parsed_dates,
+        'type': pd.Categorical(types, dtype=RECORD_TYPE_DTYPE),
+        'category': pd.Categorical(categories),
+        'amount': amounts.to_numpy(dtype='float64'),
+        'note': pd.array(notes, dtype=object),
+        'timestamp': pd.DatetimeIndex(timestamps),
+        'account_id': pd.array(account_ids, dtype=object),
+        'account_name': pd.array(account_names, dtype=object),
+    }, columns=RECORD_COLUMNS + ['account_id', 'account_name'])
+
+
+def month_bounds(month_str: str):
+    """將 'YYYY-MM' 轉為 (當月第一天, 下月第一天) 的 date 區間 (右開)"""
+    period = pd.Period(month_str, freq='M')
+    return period.start_time.date(), (period + 1).start_time.date()
+
+
+def stage_records_version_bump(batch, db: firestore.Client, user_id: str):
+    """在 WriteBatch 中遞增交易紀錄版本，讓所有 (含磁碟上的) 紀錄快取失效"""
+    batch.set(
+        get_records_meta_ref(db, user_id),
+        {'version': firestore.Increment(1), 'last_write': firestore.SERVER_TIMESTAMP},
+        merge=True
+    )
+
+
+def aggregate_month_key(value):
+    """將紀錄日期轉為彙總文件的月份鍵 (以 UTC 為準，與 'date' 的儲存方式一致)；無效日期返回 None"""
+    ts = pd.Timestamp(value) if value is not None else pd.NaT
+    if pd.isna(ts):
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert('UTC')
+    return ts.strftime('%Y-%m')
+
+
+def aggregate_category_key(category) -> str:
+    """將紀錄類別轉為彙總使用的類別鍵；缺少類別 (None/NaN/空字串) 一律歸為 '未分類'"""
+    if category is None or (isinstance(category, float) and pd.isna(category)):
+        return '未分類'
+    return str(category) or '未分類'
+
+
+def stage_aggregate_change(batch, db: firestore.Client, user_id: str, record_date, record_type: str, category: str, amount_change: float):
+    """
+    在 WriteBatch 中以 Increment 更新該月份的彙總文件
+    - by_type: {類型: 金額}；by_category: {類型: {類別: 金額}}
+    - 使用巢狀 dict (而非以 '.' 串接的欄位路徑)，類別名稱含 '/' 等字元也能安全寫入
+    """
+    stage_aggregate_changes(batch, db, user_id, [(record_date, record_type, category, amount_change)])
+
+
+def stage_aggregate_changes(batch, db: firestore.Client, user_id: str, changes):
+    """
+    將多筆 (record_date, record_type, category, amount_change) 依月份合併後寫入 WriteBatch
+    - 每個月份只產生一次寫入 (同月份的金額先在本地加總)，批次刪除時不會因每筆紀錄多一次寫入而超出上限
+    """
+    by_month = {}
+    for record_date, record_type, category, amount_change in changes:
+        month_str = aggregate_month_key(record_date)
+        if month_str is None:
+            continue # 沒有日期的紀錄不屬於任何月份
+        by_type, by_category = by_month.setdefault(month_str, ({}, {}))
+        by_type[record_type] = by_type.get(record_type, 0.0) + amount_change
+        type_categories = by_category.setdefault(record_type, {})
+        category = aggregate_category_key(category)
+        type_categories[category] = type_categories.get(category, 0.0) + amount_change
+
+    for month_str, (by_type, by_category) in by_month.items():
+        batch.set(
+            get_monthly_aggregate_ref(db, user_id, month_str),
+            {
+                'by_type': {t: firestore.Increment(v) for t, v in by_type.items()},
+                'by_category': {t: {c: firestore.Increment(v) for c, v in cats.items()} for t, cats in by_category.items()},
+            },
+            merge=True
+        )
+
+
+@st.cache_data(ttl=10, hash_funcs=CLIENT_HASH_FUNCS, show_spinner=False) # 版本號只需單一小文件讀取
+def get_records_version(db: firestore.Client, user_id: str) -> int:
+    """讀取交易紀錄版本 (寫入時遞增)；讀取失敗時拋出例外 (不快取，也不會成為快取鍵)"""
+    if db is None: return 0
+    doc = get_records_meta_ref(db, user_id).get()
+    return int(doc.to_dict().get('version', 0)) if doc.exists else 0
+
+
+def records_range_query(db: firestore.Client, user_id: str, start_date: datetime.date, end_date: datetime.date):
+    """建立 [start_date, end_date) 的紀錄範圍查詢 (依 'date' 降序)；'date' 以 UTC 儲存，因此以 UTC 午夜作為邊界"""
+    start_dt = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+    end_dt = datetime.datetime.combine(end_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+    return (get_record_ref(db, user_id)
+            .where(filter=FieldFilter('date', '>=', start_dt))
+            .where(filter=FieldFilter('date', '<', end_dt))
+            .order_by('date', direction=firestore.Query.DESCENDING))
+
+
+def get_records_in_range(db: firestore.Client, user_id: str, start_date: datetime.date, end_date: datetime.date, limit: int = None) -> pd.DataFrame:
+    """
+    以伺服器端範圍查詢取得 [start_date, end_date) 的交易紀錄
+    - 結果持久化在磁碟，以紀錄版本為鍵：重啟後只需讀取版本文件即可沿用快取
+    - limit: 只取最新的前 N 筆 (None 表示不限制)
+    - 讀取失敗時在此顯示錯誤並返回空 DataFrame (不寫入快取)
+    """
+    try:
+        return load_records_in_range(db, user_id, start_date, end_date, get_records_version(db, user_id), limit)
+    except Exception as e:
+        st.error(f"❌ 獲取交易紀錄失敗: {e}")
+        # 返回帶有正確欄位的空 DataFrame
+        return pd.DataFrame(columns=RECORD_COLUMNS)
+
+
+# 持久化快取不支援 TTL，改以 records_version 作為失效條件；_db 不參與雜湊 (跨重啟時 id 會變)
+# 讀取失敗時直接拋出例外：例外不會被快取，避免把暫時性錯誤當成「無紀錄」持久化到磁碟
+@st.cache_data(persist="disk", max_entries=24, show_spinner=False)
+def load_records_in_range(_db: firestore.Client, user_id: str, start_date: datetime.date, end_date: datetime.date, records_version: int, limit: int = None) -> pd.DataFrame:
     """
+    以伺服器端範圍查詢讀取 [start_date, end_date) 的交易紀錄
+    - 只讀取區間內的文件，讀取次數與傳輸量與結果大小成正比
+    - 'date' 以 UTC 時間儲存 (見 add_record)，因此以 UTC 午夜作為邊界
+    - 舊版字串格式或缺少 'date' 的紀錄已由 migrate_legacy_record_dates 轉為 Timestamp
+    """
+    db = _db
     if db is None: # 如果 db 未初始化
-         return pd.DataFrame(columns=['id', 'date', 'type', 'category', 'amount', 'note', 'timestamp'])
+         return pd.DataFrame(columns=RECORD_COLUMNS)
 
-    records_ref = get_record_ref(db, user_id)
+    query = records_range_query(db, user_id, start_date, end_date)
+    if limit:
+        query = query.limit(limit)
+    return records_to_dataframe(query.stream())
+
+
+def get_record_date_bounds(db: firestore.Client, user_id: str):
+    """取得最早與最晚一筆紀錄的日期；無紀錄或讀取失敗時返回 (None, None)"""
     try:
-        # 📌 修正：改用 timestamp 排序，這對所有紀錄 (新舊) 都更穩定
-        docs = records_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).get()
+        return load_record_date_bounds(db, user_id, get_records_version(db, user_id))
+    except Exception as e:
+        st.error(f"❌ 獲取紀錄日期範圍失敗: {e}")
+        return None, None
+
+
+@st.cache_data(persist="disk", max_entries=24, show_spinner=False)
+def load_record_date_bounds(_db: firestore.Client, user_id: str, records_version: int):
+    """以兩次 limit(1) 查詢取得紀錄日期範圍，而非讀取整個 Collection (只考慮 Timestamp 型別的 'date')"""
+    db = _db
+    if db is None: return None, None
+    records_ref = get_record_ref(db, user_id).where(filter=FieldFilter('date', '>=', EARLIEST_RECORD_DATE))
+    bounds = []
+    for direction in (firestore.Query.ASCENDING, firestore.Query.DESCENDING):
+        docs = list(records_ref.order_by('date', direction=direction).limit(1).stream())
+        if not docs:
+            return None, None
+        bounds.append(pd.to_datetime(docs[0].to_dict().get('date'), utc=True).date())
+    return bounds[0], bounds[1]
+
+
+def get_record_months(db: firestore.Client, user_id: str) -> list:
+    """取得有紀錄的月份 (YYYY-MM，新到舊)；無紀錄或讀取失敗時返回空列表"""
+    try:
+        return load_record_months(db, user_id, get_records_version(db, user_id))
+    except Exception as e:
+        st.error(f"❌ 獲取紀錄月份失敗: {e}")
+        return []
 
-        data = []
-        
-        # --- (這是最關鍵的修正：3 步驟備援邏輯) ---
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            
-            # --- 1. 解析 Timestamp (建立時間) ---
-            parsed_timestamp = None # 預設值
-            if 'timestamp' in doc_data and hasattr(doc_data['timestamp'], 'to_pydatetime'):
-                parsed_timestamp = doc_data['timestamp'].to_pydatetime()
-                doc_data['timestamp'] = parsed_timestamp # 儲存 datetime 物件
-            elif isinstance(doc_data.get('timestamp'), datetime.datetime):
-                parsed_timestamp = doc_data['timestamp']  # 已是 datetime 物件
-            else:
-                doc_data['timestamp'] = None # 如果無效則存 None
-
-            # --- 2. 解析 Date (交易日期) ---
-            parsed_date = None # 預設值
-            if 'date' in doc_data and hasattr(doc_data['date'], 'to_pydatetime'):
-                # 正常情況： date 是一個 Firestore Timestamp (如 image_502835.png)
-                parsed_date = doc_data['date'].to_pydatetime().date()
-            elif isinstance(doc_data.get('date'), str): 
-                # 舊格式情況： date 是一個字串
-                try:
-                    parsed_date = datetime.datetime.strptime(doc_data['date'], '%Y-%m-%d').date()
-                except (ValueError, TypeError):
-                    pass # 保持 None，讓它進入備援
-
-            # --- 3. 套用備援 (Fallback) ---
-            if parsed_date:
-                # 優先使用 'date' 欄位 (轉換為 datetime 物件)
-                doc_data['date'] = datetime.datetime.combine(parsed_date, datetime.time.min)
-            elif parsed_timestamp:
-                # 備援：使用 'timestamp' (它已經是 datetime 物件)
-                doc_data['date'] = parsed_timestamp
+
+@st.cache_data(persist="disk", max_entries=24, show_spinner=False)
+def load_record_months(_db: firestore.Client, user_id: str, records_version: int) -> list:
+    """
+    由每月彙總文件推得有紀錄的月份 (每個月份只讀一份小文件)，而非讀取全部紀錄
+    - 沒有彙總文件、或刪除後各類型金額皆歸零的月份視為沒有紀錄
+    """
+    if _db is None: return []
+    months = []
+    for doc in get_monthly_aggregates_ref(_db, user_id).select(['by_type']).stream():
+        by_type = (doc.to_dict() or {}).get('by_type') or {}
+        if any(round(safe_float(amount), 6) != 0 for amount in by_type.values()):
+            months.append(doc.id)
+    return sorted(months, reverse=True)
+
+
+def legacy_record_date(raw_date, raw_timestamp):
+    """
+    將舊版紀錄的 'date' 轉為 UTC datetime：
+    - 'YYYY-MM-DD' 等字串 → 當天午夜 UTC
+    - 缺失或無法解析 → 以 'timestamp' 備援；兩者皆無效時返回 None
+    """
+    for value in (raw_date, raw_timestamp):
+        if value is None:
+            continue
+        ts = pd.to_datetime(value, errors='coerce', utc=True)
+        if not pd.isna(ts):
+            return ts.to_pydatetime()
+    return None
+
+
+@st.cache_resource(show_spinner="正在轉換舊版紀錄日期...")
+def migrate_legacy_record_dates(_db: firestore.Client, user_id: str) -> int:
+    """
+    一次性遷移：將 'date' 為字串或缺失的紀錄轉為 Timestamp，讓伺服器端範圍查詢能匹配它們
+    - 完成後在 records_meta 記錄 legacy_dates_migrated，之後只需讀取該文件
+    - 受影響月份的彙總標記為未完成 (complete: False)，由 backfill_monthly_aggregates 重新計算
+    - 遞增紀錄版本，讓所有 (含磁碟上的) 快取失效；失敗時拋出例外 (不快取)，下次重跑再試
+    """
+    db = _db
+    meta_ref = get_records_meta_ref(db, user_id)
+    meta = meta_ref.get()
+    if meta.exists and (meta.to_dict() or {}).get('legacy_dates_migrated'):
+        return 0
+
+    updates = []
+    for doc in get_record_ref(db, user_id).select(['date', 'timestamp']).stream():
+        doc_data = doc.to_dict() or {}
+        if isinstance(doc_data.get('date'), datetime.datetime):
+            continue # 已是 Timestamp
+        new_date = legacy_record_date(doc_data.get('date'), doc_data.get('timestamp'))
+        if new_date is not None:
+            updates.append((doc.reference, new_date))
+
+    writes = [('date', ref, new_date) for ref, new_date in updates]
+    months = sorted({aggregate_month_key(new_date) for _, new_date in updates})
+    writes += [('aggregate', get_monthly_aggregate_ref(db, user_id, m), None) for m in months]
+    for i in range(0, len(writes), WRITE_BATCH_SIZE):
+        batch = db.batch()
+        for kind, ref, new_date in writes[i:i + WRITE_BATCH_SIZE]:
+            if kind == 'date':
+                batch.update(ref, {'date': new_date})
             else:
-                # 最終備援：如果兩者都缺失，才設為 None
-                doc_data['date'] = None 
-                
-            data.append(doc_data)
-        # --- (關鍵修正結束) ---
+                batch.set(ref, {'complete': False}, merge=True)
+        batch.commit()
 
+    meta_ref.set(
+        {'legacy_dates_migrated': True, 'version': firestore.Increment(1), 'last_write': firestore.SERVER_TIMESTAMP},
+        merge=True
+    )
+    clear_records_cache()
+    return len(updates)
 
-        # 預期從 Firestore 讀取的欄位
-        expected_columns = ['id', 'date', 'type', 'category', 'amount', 'note', 'timestamp']
 
-        if not data:
-            # 返回帶有正確欄位的空 DataFrame
-            return pd.DataFrame(columns=expected_columns)
+def rebuild_monthly_aggregate(db: firestore.Client, user_id: str, month_str: str) -> dict:
+    """
+    從該月份的紀錄重新計算彙總並寫回 Firestore (標記 complete)
+    - 只由一次性回填 (backfill_monthly_aggregates) 呼叫；只有被 Increment 建立、缺少 complete 標記的文件也會重算
+    - 該月份沒有任何紀錄時不寫入彙總文件
+    - 讀取彙總文件、讀取紀錄與寫回在同一個交易中完成：所有寫入路徑都會在同一批次更新彙總文件，
+      期間若有其他寫入，交易會衝突並重試，不會覆蓋掉已提交的 Increment
+    - 讀取失敗時拋出例外，不寫入任何內容 (避免寫入標記為 complete 的空彙總)
+    """
+    month_start, month_end = month_bounds(month_str)
+    aggregate_ref = get_monthly_aggregate_ref(db, user_id, month_str)
+    # 彙總只需要這四個欄位，投影查詢可省去備註等欄位的傳輸
+    query = records_range_query(db, user_id, month_start, month_end).select(list(AGGREGATE_SOURCE_FIELDS))
 
-        df = pd.DataFrame(data)
+    @firestore.transactional
+    def _rebuild(transaction):
+        snapshot = aggregate_ref.get(transaction=transaction)
+        current = snapshot.to_dict() if snapshot.exists else None
+        if current and current.get('complete'):
+            return current # 已由其他工作階段重建完成
+        df = records_to_dataframe(query.stream(transaction=transaction))
+        by_type = {}
+        by_category = {}
+        for record_type, group in df.groupby('type', observed=True):
+            by_type[str(record_type)] = float(group['amount'].sum())
+            by_category[str(record_type)] = {
+                str(category): float(amount) # records_to_dataframe 已以 aggregate_category_key 正規化
+                for category, amount in group.groupby('category', observed=True)['amount'].sum().items()
+            }
+        data = {'by_type': by_type, 'by_category': by_category, 'complete': True}
+        if not df.empty:
+            transaction.set(aggregate_ref, data)
+        return data
 
-        # 確保所有預期欄位都存在，若不存在則補上空值
-        for col in expected_columns:
-            if col not in df.columns:
-                df[col] = None
+    return _rebuild(db.transaction())
 
-        # 先統一時區處理：全部視為 UTC → 再去除時區，避免 tz-aware / tz-naive 混用
-        df['date'] = pd.to_datetime(df['date'], errors='coerce', utc=True).dt.tz_convert(None)
 
-        if 'timestamp' in df.columns:
-            df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce', utc=True).dt.tz_convert(None)
-            # 若 date 是 NaT，使用 timestamp 回填
-            mask = df['date'].isna() & df['timestamp'].notna()
-            df.loc[mask, 'date'] = df.loc[mask, 'timestamp']
+@st.cache_resource(show_spinner="正在建立每月彙總...")
+def backfill_monthly_aggregates(_db: firestore.Client, user_id: str) -> int:
+    """
+    一次性回填：為有紀錄但彙總尚未完成的月份重新計算彙總，返回重建的月份數
+    - 只讀取紀錄的 'date' 欄位找出有紀錄的月份；沒有紀錄的月份不寫入任何文件
+    - 完成後在 records_meta 記錄 aggregates_backfilled，之後的寫入都以 Increment 維護彙總，讀取時不需重算
+    - 遞增紀錄版本讓彙總快取失效；失敗時拋出例外 (不快取)，下次重跑再試 (已重建的月份會被略過)
+    """
+    db = _db
+    meta_ref = get_records_meta_ref(db, user_id)
+    meta = meta_ref.get()
+    if meta.exists and (meta.to_dict() or {}).get('aggregates_backfilled'):
+        return 0
+
+    records_ref = get_record_ref(db, user_id).where(filter=FieldFilter('date', '>=', EARLIEST_RECORD_DATE))
+    months = sorted({
+        month_str for month_str in (aggregate_month_key((doc.to_dict() or {}).get('date')) for doc in records_ref.select(['date']).stream())
+        if month_str
+    })
+    refs = [get_monthly_aggregate_ref(db, user_id, m) for m in months]
+    pending = [snapshot.id for snapshot in (db.get_all(refs) if refs else [])
+               if not (snapshot.exists and (snapshot.to_dict() or {}).get('complete'))]
+    for month_str in pending:
+        rebuild_monthly_aggregate(db, user_id, month_str)
+
+    meta_ref.set(
+        {'aggregates_backfilled': True, 'version': firestore.Increment(1), 'last_write': firestore.SERVER_TIMESTAMP},
+        merge=True
+    )
+    clear_records_cache()
+    return len(pending)
+
 
-        # 其他欄位轉型照舊
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
-        df['type'] = df['type'].astype(str)
-        df['category'] = df['category'].astype(str)
-        df['note'] = df['note'].astype(str)
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_monthly_aggregates(_db: firestore.Client, user_id: str, months: tuple, records_version: int) -> dict:
+    """
+    以單次 get_all 讀取多個月份的彙總文件，返回 {YYYY-MM: 彙總}
+    - 只讀取、不寫入；沒有彙總文件的月份即沒有紀錄 (舊資料已由 backfill_monthly_aggregates 回填)
+    """
+    aggregates = {}
+    refs = [get_monthly_aggregate_ref(_db, user_id, m) for m in months]
+    for snapshot in _db.get_all(refs):
+        if snapshot.exists:
+            aggregates[snapshot.id] = snapshot.to_dict() or {}
+    return aggregates
 
-        return df
 
+def get_monthly_aggregates(db: firestore.Client, user_id: str, start_m: str, end_m: str) -> dict:
+    """取得 start_m ~ end_m (YYYY-MM) 每個月份的彙總，不讀取任何交易紀錄文件"""
+    months = tuple(pd.period_range(start_m, end_m, freq='M').astype(str))
+    try:
+        return load_monthly_aggregates(db, user_id, months, get_records_version(db, user_id))
     except Exception as e:
-        st.error(f"❌ 獲取交易紀錄失敗: {e}")
-        # 返回帶有正確欄位的空 DataFrame
-        return pd.DataFrame(columns=['id', 'date', 'type', 'category', 'amount', 'note', 'timestamp'])
+        st.error(f"❌ 獲取每月彙總失敗: {e}")
+        return {}
 
 
-def add_record(db: firestore.Client, user_id: str, record_data: dict):
-    """向 Firestore 添加一筆交易紀錄"""
-    if db is None: return
+def aggregates_to_frame(aggregates: dict, key_col: str, record_type: str = None) -> pd.DataFrame:
+    """
+    合計多個月份的彙總，轉為 [key_col, 'amount'] 兩欄的 DataFrame
+    - record_type 為 None 時依類型合計，否則合計該類型下的各類別
+    """
+    totals = {}
+    for data in aggregates.values():
+        if record_type is None:
+            values = data.get('by_type', {})
+        else:
+            values = data.get('by_category', {}).get(record_type, {})
+        for key, amount in values.items():
+            totals[key] = totals.get(key, 0.0) + safe_float(amount)
+    # 刪除後歸零的項目不顯示
+    totals = {k: v for k, v in totals.items() if abs(v) > 1e-9}
+    return pd.DataFrame({key_col: list(totals.keys()), 'amount': list(totals.values())})
+
+
+def aggregates_to_monthly_frame(aggregates: dict) -> pd.DataFrame:
+    """將每月彙總展開為 ['month_str', 'type', 'amount'] 的 DataFrame (供長條圖使用)"""
+    rows = [
+        (month_str, record_type, safe_float(amount))
+        for month_str, data in sorted(aggregates.items())
+        for record_type, amount in data.get('by_type', {}).items()
+        if abs(safe_float(amount)) > 1e-9
+    ]
+    return pd.DataFrame(rows, columns=['month_str', 'type', 'amount'])
+
+
+def clear_records_cache():
+    """寫入後清除所有交易紀錄相關的快取 (其他行程則透過版本號失效)"""
+    get_records_version.clear()
+    load_records_in_range.clear()
+    load_record_date_bounds.clear()
+    load_record_months.clear()
+    load_monthly_aggregates.clear()
+
+
+def fetch_month_summary_and_balance(db: firestore.Client, user_id: str, month_str: str):
+    """
+    並行讀取某月份 (YYYY-MM) 的彙總文件與總餘額 (兩個互相獨立的單一文件讀取)
+    - 卡片只需要當月收支合計，直接讀彙總文件，不讀取當月交易紀錄
+    - 將目前的 ScriptRunContext 附加到工作執行緒，讓快取與 st.error 正常運作
+    """
+    ctx = get_script_run_ctx()
+
+    def _run(fn, *args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(db, user_id, *args)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        f_summary = executor.submit(_run, get_monthly_aggregates, month_str, month_str)
+        f_balance = executor.submit(_run, get_current_balance)
+        return f_summary.result().get(month_str, {}), f_balance.result()
+
+
+def prepare_record_dates(record_data: dict, now_utc: datetime.datetime):
+    """
+    將紀錄的 'date' (.date 物件) 轉為寫入 Firestore 的 UTC datetime，並設定 'timestamp'
+    - 今天 (以 UTC 日期為準)：'date' 等於當下精確的 UTC 時間
+    - 過去的某天 (補登)：那天的午夜 UTC (00:00 UTC)
+    - 日期格式無法識別：使用當下時間
+    """
+    # 1. 獲取用戶選擇的日期 (這是一個 .date 物件)
+    record_date_obj = record_data.get('date') 
+    
+    # 2. 當前的 *UTC* 時間 (now_utc，timezone-aware) 由呼叫端傳入
+    # 這樣可以確保無論伺服器在哪個時區，時間都是標準的
+    
+    # 3. 判斷 'date' 欄位的值
+    if isinstance(record_date_obj, datetime.date) and record_date_obj == now_utc.date():
+        # 情況 A: 如果用戶選擇的是 "今天" (以 UTC 日期為準)
+        # 讓 'date' 等於 'timestamp'，都設為當下精確的 UTC 時間
+        record_data['date'] = now_utc
+    
+    elif isinstance(record_date_obj, datetime.date):
+        # 情況 B: 如果用戶選擇的是 "過去的某天" (補登)
+        # 則將 'date' 設為那天的 "午夜 UTC" (00:00 UTC)
+        # 我們明確地加入 tzinfo=datetime.timezone.utc
+        record_data['date'] = datetime.datetime.combine(record_date_obj, datetime.time.min, tzinfo=datetime.timezone.utc)
+    
+    else:
+        # 情況 C: 備援，如果日期格式不對，也使用當下時間
+        st.warning("日期格式無法識別，已使用當前時間。")
+        record_data['date'] = now_utc
+
+    # 4. 確保 'timestamp' 欄位 *總是* 儲存當下精確的 UTC 時間
+    record_data['timestamp'] = now_utc
+
+
+def add_record(db: firestore.Client, user_id: str, record_data: dict, account_id: str = None, account_name: str = None, account_delta: float = 0.0) -> bool:
+    """
+    向 Firestore 添加一筆交易紀錄，返回是否寫入成功
+    - account_id/account_name/account_delta: 指定時，帳戶餘額的 Increment 與紀錄在同一個 WriteBatch 中提交
+    """
+    if db is None: return False
     records_ref = get_record_ref(db, user_id)
     try:
-        # 1. 獲取用戶選擇的日期 (這是一個 .date 物件)
-        record_date_obj = record_data.get('date') 
-        
-        # 2. 獲取當前的 *UTC* 時間 (使用 timezone-aware)
-        # 這樣可以確保無論伺服器在哪個時區，時間都是標準的
+        # 1~4. 將日期轉為 UTC datetime，並寫入當下的 'timestamp'
         now_utc = datetime.datetime.now(datetime.timezone.utc)
-        
-        # 3. 判斷 'date' 欄位的值
-        if isinstance(record_date_obj, datetime.date) and record_date_obj == now_utc.date():
-            # 情況 A: 如果用戶選擇的是 "今天" (以 UTC 日期為準)
-            # 讓 'date' 等於 'timestamp'，都設為當下精確的 UTC 時間
-            record_data['date'] = now_utc
-        
-        elif isinstance(record_date_obj, datetime.date):
-            # 情況 B: 如果用戶選擇的是 "過去的某天" (補登)
-            # 則將 'date' 設為那天的 "午夜 UTC" (00:00 UTC)
-            # 我們明確地加入 tzinfo=datetime.timezone.utc
-            record_data['date'] = datetime.datetime.combine(record_date_obj, datetime.time.min, tzinfo=datetime.timezone.utc)
-        
-        else:
-            # 情況 C: 備援，如果日期格式不對，也使用當下時間
-            st.warning("日期格式無法識別，已使用當前時間。")
-            record_data['date'] = now_utc
+        prepare_record_dates(record_data, now_utc)
 
-        # 4. 確保 'timestamp' 欄位 *總是* 儲存當下精確的 UTC 時間
-        record_data['timestamp'] = now_utc
+        # 5. 紀錄寫入與餘額更新合併為單一 WriteBatch (一次往返，且具原子性)
+        amount = float(record_data['amount'])
+        amount_change = amount if record_data['type'] == '收入' else -amount
 
-        doc_ref = records_ref.add(record_data) # add 會返回 DocumentReference 和 timestamp
-        st.toast("✅ 交易紀錄已新增！", icon="🎉")
+        batch = db.batch()
+        batch.set(records_ref.document(), record_data) # 自動產生文件 ID
+        stage_balance_change(batch, db, user_id, amount_change)
+        stage_aggregate_change(batch, db, user_id, record_data['date'], record_data['type'], record_data['category'], amount)
+        if account_id:
+            stage_bank_account_changes(batch, db, user_id, {account_id: (account_name, account_delta)})
+        stage_records_version_bump(batch, db, user_id)
+        batch.commit()
 
-        # 更新餘額
-        amount = float(record_data['amount'])
-        operation = 'add' if record_data['type'] == '收入' else 'subtract'
-        update_balance_transactional(db, user_id, amount, operation)
+        get_current_balance.clear()
+        if account_id:
+            load_bank_accounts.clear()
+        clear_records_cache()
+        st.toast("✅ 交易紀錄已新增！", icon="🎉")
+        return True
 
     except Exception as e:
         st.error(f"❌ 新增紀錄失敗: {e}")
         st.error(f"紀錄數據: {record_data}") # 打印出問題數據幫助除錯
+        return False
+
+def add_records(db: firestore.Client, user_id: str, records: list) -> int:
+    """
+    批次新增多筆交易紀錄 (匯入用)，返回成功寫入的筆數
+    - 每個 WriteBatch 最多 WRITE_BATCH_SIZE 筆，紀錄與該批合併後的餘額/彙總/帳戶餘額增減一併提交 (原子性)
+    - 帳戶餘額依紀錄的 account_id/account_name 以 Increment 調整，不依賴畫面上的帳戶快照
+    - 多個批次以執行緒池並行提交，不再逐筆往返
+    """
+    if db is None or not records: return 0
+    records_ref = get_record_ref(db, user_id)
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    for record_data in records:
+        prepare_record_dates(record_data, now_utc)
+    chunks = [records[i:i + WRITE_BATCH_SIZE] for i in range(0, len(records), WRITE_BATCH_SIZE)]
+
+    def _commit_chunk(chunk):
+        batch = db.batch()
+        net_change = 0.0
+        aggregate_changes = []
+        account_changes = {}
+        for record_data in chunk:
+            amount = float(record_data['amount'])
+            signed_amount = amount if record_data['type'] == '收入' else -amount
+            batch.set(records_ref.document(), record_data) # 自動產生文件 ID
+            net_change += signed_amount
+            aggregate_changes.append((record_data['date'], record_data['type'], record_data['category'], amount))
+            account_id = record_data.get('account_id')
+            if account_id:
+                account_name, delta = account_changes.get(account_id, (record_data.get('account_name', ''), 0.0))
+                account_changes[account_id] = (account_name, delta + signed_amount)
+        stage_aggregate_changes(batch, db, user_id, aggregate_changes)
+        if net_change:
+            stage_balance_change(batch, db, user_id, net_change)
+        stage_bank_account_changes(batch, db, user_id, account_changes)
+        stage_records_version_bump(batch, db, user_id)
+        batch.commit()
+        return len(chunk)
+
+    success_count = 0
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+        futures = [executor.submit(_commit_chunk, chunk) for chunk in chunks]
+        for future in futures:
+            try:
+                success_count += future.result()
+            except Exception as e:
+                st.error(f"❌ 批次新增紀錄失敗: {e}")
+
+    get_current_balance.clear()
+    load_bank_accounts.clear()
+    clear_records_cache()
+    return success_count
 
-def delete_record(db: firestore.Client, user_id: str, record_id: str, record_type: str, record_amount: float):
-    """從 Firestore 刪除一筆交易紀錄並回滾餘額"""
+def delete_record(db: firestore.Client, user_id: str, record_id: str, record_type: str, record_amount: float, record_category: str, record_date):
+    """從 Firestore 刪除一筆交易紀錄並回滾餘額與每月彙總"""
     if db is None: return
     record_doc_ref = get_record_ref(db, user_id).document(record_id)
     try:
-        record_doc_ref.delete()
-        
+        # 刪除紀錄與回滾餘額 (注意方向相反) 合併為單一 WriteBatch
+        amount_change = -float(record_amount) if record_type == '收入' else float(record_amount)
+        batch = db.batch()
+        batch.delete(record_doc_ref)
+        stage_balance_change(batch, db, user_id, amount_change)
+        stage_aggregate_change(batch, db, user_id, record_date, record_type, record_category, -float(record_amount))
+        stage_records_version_bump(batch, db, user_id)
+        batch.commit()
+
         # 📌 --- 修正：在這裡手動清除快取 --- 📌
-        # 確保 get_all_records 函式的快取被清除
-        get_all_records.clear() 
-        
+        # 確保交易紀錄的快取被清除
+        clear_records_cache() 
+        get_current_balance.clear()
+
         st.toast("🗑️ 交易紀錄已刪除！", icon="✅")
+        # 不需 st.rerun()：刪除由表格回呼觸發，之後的自然重跑只會重新讀取一次資料
+
+    except Exception as e:
+        st.error(f"❌ 刪除紀錄失敗: {e}")
 
-        # 回滾餘額
-        operation = 'subtract' if record_type == '收入' else 'add' # 注意操作相反
-        update_balance_transactional(db, user_id, float(record_amount), operation)
+def delete_records(db: firestore.Client, user_id: str, records: list):
+    """
+    一次刪除多筆交易紀錄並合併回滾餘額
+    - records: [(record_id, record_type, record_amount, record_category, record_date), ...]
+    - 每個 WriteBatch 最多 WRITE_BATCH_SIZE 筆，刪除與該批合併後的餘額/彙總增減一併提交 (原子性)
+    - 多個批次以執行緒池並行提交
+    """
+    if db is None or not records: return
+    records_ref = get_record_ref(db, user_id)
+    chunks = [records[i:i + WRITE_BATCH_SIZE] for i in range(0, len(records), WRITE_BATCH_SIZE)]
+
+    def _commit_chunk(chunk):
+        batch = db.batch()
+        # 回滾餘額：收入扣回、支出加回
+        net_change = 0.0
+        aggregate_changes = []
+        for record_id, record_type, record_amount, record_category, record_date in chunk:
+            batch.delete(records_ref.document(record_id))
+            net_change += -safe_float(record_amount) if record_type == '收入' else safe_float(record_amount)
+            aggregate_changes.append((record_date, record_type, record_category, -safe_float(record_amount)))
+        # 彙總依月份合併：整批只有 (月份數) 次彙總寫入，而非每筆一次
+        stage_aggregate_changes(batch, db, user_id, aggregate_changes)
+        if net_change:
+            stage_balance_change(batch, db, user_id, net_change)
+        stage_records_version_bump(batch, db, user_id)
+        batch.commit()
 
-        st.rerun() # 強制刷新頁面
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+            list(executor.map(_commit_chunk, chunks))
+
+        clear_records_cache()
+        get_current_balance.clear()
+        st.toast(f"🗑️ 已刪除 {len(records)} 筆交易紀錄！", icon="✅")
 
     except Exception as e:
+        clear_records_cache()
+        get_current_balance.clear()
         st.error(f"❌ 刪除紀錄失敗: {e}")
 
 def update_record(db: firestore.Client, user_id: str, record_id: str, new_data: dict, old_data: dict):
@@ -463,14 +1007,6 @@ def update_record(db: firestore.Client, user_id: str, record_id: str, new_data:
     
     # 我們只更新這幾個欄位，保留原始的 timestamp
     try:
-        record_doc_ref.update({
-            'date': write_data['date'],
-            'type': write_data['type'],
-            'category': write_data['category'],
-            'amount': write_data['amount'],
-            'note': write_data['note']
-        })
-        
         # 2. 計算餘額變動
         # 舊的餘額影響
         old_amount = old_data.get('amount', 0)
@@ -483,24 +1019,37 @@ def update_record(db: firestore.Client, user_id: str, record_id: str, new_data:
         # 淨變動
         net_balance_change = new_balance_effect - old_balance_effect
         
-        # 3. 套用餘額變動
-        if net_balance_change > 0:
-            update_balance_transactional(db, user_id, net_balance_change, 'add')
-        elif net_balance_change < 0:
-            update_balance_transactional(db, user_id, abs(net_balance_change), 'subtract')
+        # 3. 紀錄更新與餘額變動合併為單一 WriteBatch
+        batch = db.batch()
+        batch.update(record_doc_ref, {
+            'date': write_data['date'],
+            'type': write_data['type'],
+            'category': write_data['category'],
+            'amount': write_data['amount'],
+            'note': write_data['note']
+        })
+        if net_balance_change:
+            stage_balance_change(batch, db, user_id, net_balance_change)
         # else: 餘額不變，無需操作
+        # 每月彙總：扣除舊紀錄並加上新紀錄 (月份/類型/類別皆可能改變；同月份合併為一次寫入)
+        stage_aggregate_changes(batch, db, user_id, [
+            (old_data.get('date'), old_data.get('type'), old_data.get('category'), -old_amount),
+            (write_data['date'], new_data.get('type'), new_data.get('category'), new_amount),
+        ])
+        stage_records_version_bump(batch, db, user_id)
+        batch.commit()
             
         st.toast("✅ 紀錄已更新！", icon="🎉")
         
         # 4. 清除快取 
-        get_all_records.clear() 
+        clear_records_cache() 
         get_current_balance.clear()
         
     except Exception as e:
         st.error(f"❌ 更新紀錄失敗: {e}")
 
 
-@st.cache_data(ttl=300, hash_funcs={firestore.Client: id}) # 緩存銀行帳戶數據 5 分鐘
+@st.cache_data(ttl=300, hash_funcs=CLIENT_HASH_FUNCS) # 緩存銀行帳戶數據 5 分鐘
 def load_bank_accounts(db: firestore.Client, user_id: str) -> dict:
     """從 Firestore 加載銀行帳戶列表"""
     if db is None: return {}
@@ -545,10 +1094,7 @@ def convert_df_to_csv(df: pd.DataFrame):
     if df is None or df.empty:
         return "".encode('utf-8') # 返回空的字節串
 
-    # 複製 DataFrame 以避免修改原始數據
-    df_copy = df.copy()
-
-    # 原始欄位名 (必須與 get_all_records 返回的 DataFrame 一致)
+    # 原始欄位名 (必須與 records_to_dataframe 返回的 DataFrame 一致)
     # 假設為: 'id', 'date', 'type', 'category', 'amount', 'note', 'timestamp'
     column_mapping = {
         'date': '日期',
@@ -561,8 +1107,9 @@ def convert_df_to_csv(df: pd.DataFrame):
     }
 
     # 實際存在的欄位進行重命名
-    cols_to_rename = {k: v for k, v in column_mapping.items() if k in df_copy.columns}
-    df_renamed = df_copy.rename(columns=cols_to_rename)
+    cols_to_rename = {k: v for k, v in column_mapping.items() if k in df.columns}
+    # rename 本身即回傳新的 DataFrame，不會修改原始數據，無需先複製
+    df_renamed = df.rename(columns=cols_to_rename)
 
     # 定義最終要匯出的欄位順序 (使用中文名稱)
     target_columns_ordered = ['日期', '類型', '類別', '金額', '備註', '文件ID', '儲存時間']
@@ -602,31 +1149,20 @@ def convert_df_to_csv(df: pd.DataFrame):
 
 
 # --- 6. UI 組件 ---
+@st.fragment # 元件互動只重跑此區塊，不重跑整個 app
 def display_dashboard(db, user_id):
     """首頁儀表板：資產概況卡片 + 收支分析圖表 (已修改：新增時間區間快捷選項)"""
     
-    # --- 1. 取得資料 ---
-    df = get_all_records(db, user_id)
-    current_balance = get_current_balance(db, user_id)
-
-    # 確保日期格式正確
-    if not df.empty and 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
-        df['month_str'] = df['date'].dt.strftime('%Y-%m')
+    # --- 1. 取得資料 (本月彙總文件 + 總餘額，共兩次單一文件讀取) ---
+    today = datetime.date.today()
+    month_summary, current_balance = fetch_month_summary_and_balance(db, user_id, today.strftime('%Y-%m'))
 
     # --- 2. 資產概況卡片區塊 (保持原樣) ---
     st.markdown("### 📊 資產概況")
     
-    today = datetime.date.today()
-    this_month_str = today.strftime('%Y-%m')
-    
-    income_this_month = 0
-    expense_this_month = 0
-    
-    if not df.empty and 'month_str' in df.columns:
-        monthly_df = df[df['month_str'] == this_month_str]
-        income_this_month = monthly_df[monthly_df['type'] == '收入']['amount'].sum()
-        expense_this_month = monthly_df[monthly_df['type'] == '支出']['amount'].sum()
+    type_sums = month_summary.get('by_type', {})
+    income_this_month = safe_float(type_sums.get('收入', 0))
+    expense_this_month = safe_float(type_sums.get('支出', 0))
 
     c1, c2, c3 = st.columns(3)
     with c1:
@@ -641,7 +1177,8 @@ def display_dashboard(db, user_id):
     # --- 3. 收支分析 ---
     st.markdown("### 📈 收支趨勢分析")
 
-    if df.empty:
+    min_date_db, _ = get_record_date_bounds(db, user_id)
+    if min_date_db is None:
         st.info("目前沒有交易紀錄，無法顯示圖表。")
         return
 
@@ -670,18 +1207,12 @@ def display_dashboard(db, user_id):
 
         # 準備月份列表 (供計算與滑桿使用)
         start_bound = today - datetime.timedelta(days=400) 
-        if not df.empty and 'date' in df.columns:
-            min_date_db = df['date'].min().date()
-            if min_date_db < start_bound:
-                start_bound = min_date_db.replace(day=1)
-        
-        month_idx = pd.date_range(start=start_bound.replace(day=1), end=today, freq='MS')
-        month_options = month_idx.strftime('%Y-%m').tolist()
+        if min_date_db < start_bound:
+            start_bound = min_date_db.replace(day=1)
         
-        curr_month_str = today.strftime('%Y-%m')
-        if curr_month_str not in month_options:
-            month_options.append(curr_month_str)
-        month_options = sorted(list(set(month_options)))
+        # period_range 已依時間遞增且必含本月 (區間終點為 today)，不需再去重與排序
+        month_options = pd.period_range(start=start_bound, end=today, freq='M').astype(str).tolist()
+        curr_month_str = month_options[-1]
 
         # 決定最終篩選範圍
         selected_range = None
@@ -720,23 +1251,18 @@ def display_dashboard(db, user_id):
             selected_range = (start_str, end_str)
         # 🔴 修改結束
 
-    # --- 資料篩選 ---
-    if isinstance(selected_range, tuple):
-        start_m, end_m = selected_range
-        mask = (df['month_str'] >= start_m) & (df['month_str'] <= end_m)
-        df_filtered = df.loc[mask].copy()
-    else:
-        mask = (df['month_str'] == selected_range)
-        df_filtered = df.loc[mask].copy()
-
-    if df_filtered.empty:
-        st.info(f"所選區間 ({selected_range[0]} ~ {selected_range[1]}) 無資料。")
-        return
+    start_m, end_m = selected_range
 
     # --- 圖表繪製 (保持不變) ---
     
     # === 模式 A: 長條圖 (趨勢) ===
     if chart_mode == "長條圖 (趨勢)":
+        # --- 資料來源：每月彙總文件 (每月一份)，長條圖只需月份 × 類型的合計，不需讀取交易紀錄 ---
+        df_monthly = aggregates_to_monthly_frame(get_monthly_aggregates(db, user_id, start_m, end_m))
+        if df_monthly.empty:
+            st.info(f"所選區間 ({start_m} ~ {end_m}) 無資料。")
+            return
+
         c1, c2 = st.columns([1, 3])
         with c1:
             st.markdown(
@@ -769,23 +1295,13 @@ def display_dashboard(db, user_id):
         if not selected_types:
             st.warning("請至少選擇一種項目")
         else:
-            df_bar = df_filtered[df_filtered['type'].isin(selected_types)].groupby(['month_str', 'type'])['amount'].sum().reset_index()
+            df_bar = df_monthly[df_monthly['type'].isin(selected_types)]
             
             if df_bar.empty:
                 st.info("此區間無相關紀錄。")
             else:
-                domain = ['支出', '收入']
-                range_ = ['#dc3545', '#28a745'] 
-
-                bar_chart = alt.Chart(df_bar).mark_bar().encode(
-                    x=alt.X('month_str', title='月份', axis=alt.Axis(labelAngle=-45)),
-                    y=alt.Y('amount', title='金額 (NTD)'),
-                    color=alt.Color('type', scale=alt.Scale(domain=domain, range=range_), title='類型'),
-                    xOffset='type',
-                    tooltip=['month_str', 'type', alt.Tooltip('amount', format=',.0f', title='金額')]
-                ).properties(height=300)
-                
-                st.altair_chart(bar_chart, use_container_width=True)
+                bar_items = tuple(df_bar.itertuples(index=False, name=None))
+                st.vega_lite_chart(spec=build_bar_chart(bar_items), use_container_width=True)
 
     # === 模式 B: 圓餅圖 (佔比) ===
     else:
@@ -797,46 +1313,70 @@ def display_dashboard(db, user_id):
                 key="pie_target_selector"
             )
 
-        df_pie = pd.DataFrame()
-        color_enc = None
-        tooltip_enc = [] 
+        # 圓餅圖直接讀取每月彙總文件 (每月一份)，不需掃描交易紀錄
+        aggregates = get_monthly_aggregates(db, user_id, start_m, end_m)
 
         if pie_target == "月總收入 v.s. 月總支出":
-            df_pie = df_filtered.groupby('type')['amount'].sum().reset_index()
-            domain = ['支出', '收入']
-            range_ = ['#dc3545', '#28a745']
-            color_enc = alt.Color('type', scale=alt.Scale(domain=domain, range=range_), title='類型')
-            tooltip_enc = ['type', alt.Tooltip('amount', format=',.0f', title='金額')]
-            
+            df_pie = aggregates_to_frame(aggregates, 'type')
         elif pie_target == "支出類別佔比":
-            df_pie = df_filtered[df_filtered['type'] == '支出'].groupby('category')['amount'].sum().reset_index()
-            color_enc = alt.Color('category', title='類別', scale=alt.Scale(scheme='category20b'))
-            tooltip_enc = ['category', alt.Tooltip('amount', format=',.0f', title='金額')]
-
-        elif pie_target == "收入類別佔比":
-            df_pie = df_filtered[df_filtered['type'] == '收入'].groupby('category')['amount'].sum().reset_index()
-            color_enc = alt.Color('category', title='類別', scale=alt.Scale(scheme='category20c'))
-            tooltip_enc = ['category', alt.Tooltip('amount', format=',.0f', title='金額')]
+            df_pie = aggregates_to_frame(aggregates, 'category', '支出')
+        else:
+            df_pie = aggregates_to_frame(aggregates, 'category', '收入')
 
         if df_pie.empty:
             st.info("此區間無相關資料可供分析。")
         else:
-            base = alt.Chart(df_pie).encode(theta=alt.Theta('amount', stack=True))
-            
-            pie = base.mark_arc(outerRadius=100).encode(
-                color=color_enc,
-                tooltip=tooltip_enc,
-                order=alt.Order("amount", sort="descending") 
-            )
-            
-            text = base.mark_text(radius=120).encode(
-                text=alt.Text("amount", format=".0f"), 
-                order=alt.Order("amount", sort="descending"),
-                color=alt.value("black")  
-            )
-            
-            st.altair_chart(pie + text, use_container_width=True)
+            pie_items = tuple(df_pie.itertuples(index=False, name=None))
+            st.vega_lite_chart(spec=build_pie_chart(pie_target, pie_items), use_container_width=True)
+
+# 快取序列化後的 Vega-Lite 規格 (dict)：資料未變時不必重建與重新驗證 Altair 圖表物件
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_bar_chart(items: tuple) -> dict:
+    """依 (月份, 類型, 金額) 資料建立收支趨勢長條圖的 Vega-Lite 規格"""
+    df_bar = pd.DataFrame(list(items), columns=['month_str', 'type', 'amount'])
+    domain = ['支出', '收入']
+    range_ = ['#dc3545', '#28a745'] 
+
+    return alt.Chart(df_bar).mark_bar().encode(
+        x=alt.X('month_str', title='月份', axis=alt.Axis(labelAngle=-45)),
+        y=alt.Y('amount', title='金額 (NTD)'),
+        color=alt.Color('type', scale=alt.Scale(domain=domain, range=range_), title='類型'),
+        xOffset='type',
+        tooltip=['month_str', 'type', alt.Tooltip('amount', format=',.0f', title='金額')]
+    ).properties(height=300).to_dict()
+
+@st.cache_data(max_entries=32, show_spinner=False) # 同上，快取 Vega-Lite 規格
+def build_pie_chart(pie_target: str, items: tuple) -> dict:
+    """依分析維度與 (鍵, 金額) 資料建立圓餅圖 (含數值標籤) 的 Vega-Lite 規格"""
+    if pie_target == "月總收入 v.s. 月總支出":
+        df_pie = pd.DataFrame(list(items), columns=['type', 'amount'])
+        domain = ['支出', '收入']
+        range_ = ['#dc3545', '#28a745']
+        color_enc = alt.Color('type', scale=alt.Scale(domain=domain, range=range_), title='類型')
+        tooltip_enc = ['type', alt.Tooltip('amount', format=',.0f', title='金額')]
+    else:
+        df_pie = pd.DataFrame(list(items), columns=['category', 'amount'])
+        scheme = 'category20b' if pie_target == "支出類別佔比" else 'category20c'
+        color_enc = alt.Color('category', title='類別', scale=alt.Scale(scheme=scheme))
+        tooltip_enc = ['category', alt.Tooltip('amount', format=',.0f', title='金額')]
 
+    base = alt.Chart(df_pie).encode(theta=alt.Theta('amount', stack=True))
+    
+    pie = base.mark_arc(outerRadius=100).encode(
+        color=color_enc,
+        tooltip=tooltip_enc,
+        order=alt.Order("amount", sort="descending") 
+    )
+    
+    text = base.mark_text(radius=120).encode(
+        text=alt.Text("amount", format=".0f"), 
+        order=alt.Order("amount", sort="descending"),
+        color=alt.value("black")  
+    )
+    
+    return (pie + text).to_dict()
+
+@st.fragment # 元件互動只重跑此區塊，不重跑整個 app
 def display_record_input(db, user_id):
     """顯示新增交易紀錄的表單 (已修正：即時顯示自訂輸入框，移除 st.form)"""
     st.markdown("## 新增交易")
@@ -844,7 +1384,7 @@ def display_record_input(db, user_id):
     # 1. 類型選擇
     record_type = st.radio(
         "選擇類型",
-        options=['支出', '收入'],
+        options=RECORD_TYPE_OPTIONS,
         horizontal=True,
         key='record_type_selector',
         help="選擇交易是收入還是支出"
@@ -855,16 +1395,10 @@ def display_record_input(db, user_id):
     col1, col2 = st.columns(2)
 
     # 2. 類別 (根據 record_type 動態更新)
-    category_options = CATEGORIES.get(record_type, [])
     if record_type == '支出':
-        try:
-            all_db_categories = get_all_categories(db, user_id)
-        except:
-            all_db_categories = []
-        unique_categories = sorted(list(set(category_options + all_db_categories)))
-        category_options = unique_categories + ["⚙️ 新增自訂支出類別..."]
-    elif record_type == '收入':
-         category_options = CATEGORIES.get('收入', [])
+        category_options = get_expense_category_options(db, user_id) + (NEW_CATEGORY_OPTION,)
+    else:
+        category_options = CATEGORIES.get(record_type, ())
 
     # 使用 session state key 來管理，以便重置
     category = col1.selectbox(
@@ -874,7 +1408,7 @@ def display_record_input(db, user_id):
     )
 
     custom_category = ""
-    if category == "⚙️ 新增自訂支出類別...":
+    if category == NEW_CATEGORY_OPTION:
         custom_category = col1.text_input("輸入新類別名稱", key='input_custom_category', placeholder="例如：寵物用品")
 
     # 3. 金額
@@ -904,11 +1438,10 @@ def display_record_input(db, user_id):
             if isinstance(data, dict):
                 name_to_id[data.get('name')] = aid
 
-    default_methods = ['現金', '信用卡', '悠遊卡']
     existing_names = list(name_to_id.keys())
-    other_accounts = sorted([n for n in existing_names if n not in default_methods])
+    other_accounts = sorted([n for n in existing_names if n not in DEFAULT_PAYMENT_METHODS])
     
-    display_options = ['（未選擇）'] + default_methods + other_accounts + ['⚙️ 新增自訂...']
+    display_options = ['（未選擇）'] + DEFAULT_PAYMENT_METHODS + other_accounts + ['⚙️ 新增自訂...']
 
     payment_method = col3.selectbox(
         "支付方式",
@@ -935,7 +1468,7 @@ def display_record_input(db, user_id):
         
         # --- 驗證邏輯 ---
         final_category = category
-        if category == "⚙️ 新增自訂支出類別...":
+        if category == NEW_CATEGORY_OPTION:
             if not custom_category.strip():
                 st.warning("⚠️ 請輸入自訂類別的名稱。")
                 st.stop()
@@ -976,27 +1509,22 @@ def display_record_input(db, user_id):
             record_data['account_id'] = final_account_id
             record_data['account_name'] = final_account_name
 
-        add_record(db, user_id, record_data)
-
-        # --- 更新餘額 ---
+        delta = float(safe_int(amount)) * (-1.0 if record_type == '支出' else 1.0)
+        current_bal = 0.0
         if final_account_id:
             try:
-                ba = load_bank_accounts(db, user_id) or {}
-                if not isinstance(ba, dict): ba = {}
-                
-                current_acc_data = ba.get(final_account_id, {'name': final_account_name, 'balance': 0})
-                if 'name' not in current_acc_data: current_acc_data['name'] = final_account_name
-                
-                current_bal = safe_float(current_acc_data.get('balance', 0))
-                delta = float(safe_int(amount)) * (-1.0 if record_type == '支出' else 1.0)
-                new_bal = current_bal + delta
-                
-                ba[final_account_id] = {'name': final_account_name, 'balance': new_bal}
-                
-                update_bank_accounts(db, user_id, ba)
-                st.toast(f"🏦 已更新「{final_account_name}」餘額：NT$ {int(new_bal):,}")
-            except Exception as _e:
-                st.warning(f"⚠️ 支付方式餘額未能同步更新：{_e}")
+                ba = load_bank_accounts(db, user_id) or {} # 快取值，只用於顯示預估的新餘額
+                if isinstance(ba, dict):
+                    current_bal = safe_float(ba.get(final_account_id, {}).get('balance', 0))
+            except Exception:
+                pass
+
+        # 紀錄與帳戶餘額 (伺服器端 Increment) 在同一個 WriteBatch 中提交，失敗時兩者都不會寫入
+        if not add_record(db, user_id, record_data, final_account_id, final_account_name, delta):
+            return # 保留輸入內容與錯誤訊息，不重跑
+
+        if final_account_id:
+            st.toast(f"🏦 已更新「{final_account_name}」餘額：NT$ {int(current_bal + delta):,}")
 
         st.toast("✅ 交易紀錄已儲存！")
         
@@ -1007,14 +1535,15 @@ def display_record_input(db, user_id):
                 del st.session_state[k]
         
         # 由於 selectbox 比較難直接清空，透過 rerun 重新加載頁面來恢復預設值
-        st.cache_data.clear()
+        # add_record 已清除紀錄/餘額快取；這裡只需清除類別選項 (可能新增了自訂類別)，保留其他 (含磁碟上的) 快取
+        clear_category_cache()
         
         # 稍微延遲以顯示 Toast
         import time
         time.sleep(0.5)
-        st.rerun()
+        st.rerun(scope="app") # 已寫入資料：重跑整個 app 以更新儀表板
 
-@st.cache_data(ttl=300, hash_funcs={firestore.Client: id}) # 緩存類別列表 5 分鐘
+@st.cache_data(ttl=300, hash_funcs=CLIENT_HASH_FUNCS) # 緩存類別列表 5 分鐘
 def get_all_categories(db: firestore.Client, user_id: str) -> list:
     """從 Firestore 獲取用戶所有使用過的支出類別"""
     if db is None: return []
@@ -1029,8 +1558,22 @@ def get_all_categories(db: firestore.Client, user_id: str) -> list:
         # st.warning(f"獲取歷史類別失敗: {e}") # 正式版可移除警告
         return []
 
+@st.cache_data(ttl=300, hash_funcs=CLIENT_HASH_FUNCS) # 與 get_all_categories 同步快取 5 分鐘
+def get_expense_category_options(db: firestore.Client, user_id: str) -> tuple:
+    """預設支出類別與歷史類別合併後的排序選項，避免每次重跑重新建立 set 並排序"""
+    try:
+        all_db_categories = get_all_categories(db, user_id)
+    except Exception:
+        all_db_categories = []
+    return tuple(sorted(set(CATEGORIES['支出']).union(all_db_categories)))
+
+def clear_category_cache():
+    """新增紀錄後清除類別選項快取 (可能出現新的自訂類別)"""
+    get_all_categories.clear()
+    get_expense_category_options.clear()
+
 
-def display_records_list(db, user_id, df_records):
+def display_records_list(db, user_id):
     """顯示交易紀錄列表 (📌 修正版：移除範例按鈕，將下載紀錄格式統一為中文以兼作範例)"""
     
     # --- 1. 預先載入支付方式選項 ---
@@ -1040,36 +1583,22 @@ def display_records_list(db, user_id, df_records):
         bank_accounts = {}
     
     name_to_id = {data.get('name'): aid for aid, data in bank_accounts.items() if isinstance(data, dict)}
-    default_methods = ['現金', '信用卡', '悠遊卡']
     existing_names = list(name_to_id.keys())
-    base_payment_options = default_methods + sorted([n for n in existing_names if n not in default_methods])
+    base_payment_options = DEFAULT_PAYMENT_METHODS + sorted([n for n in existing_names if n not in DEFAULT_PAYMENT_METHODS])
 
     # --- 2. 標題 ---
     st.markdown("## 歷史紀錄")
 
-    if df_records is None:
-        df_records = pd.DataFrame()
-
     # --- 3. 篩選與操作區塊 ---
     # 欄位規劃：月份(1.5) | 類型(1) | 空白(0.5) | 上傳區(2.5) | 下載區(1.5)
     col1, col2, col3, col_import, col4 = st.columns([1.5, 1, 0.5, 2.5, 1.5])
     
-    # [Col 1] 月份篩選
-    if 'date' not in df_records.columns or not pd.api.types.is_datetime64_any_dtype(df_records['date']):
-         all_months = []
-         selected_month = None
+    # [Col 1] 月份篩選 (只列出有紀錄的月份；由每月彙總文件推得，不需讀取全部紀錄)
+    all_months = get_record_months(db, user_id)
+    if not all_months:
+        selected_month = None
     else:
-        date_series = df_records['date'].dropna()
-        if not date_series.empty:
-            df_copy = df_records.copy()
-            df_copy['month_year_period'] = df_copy['date'].dt.to_period('M')
-            all_months = sorted(df_copy['month_year_period'].dropna().unique().astype(str), reverse=True)
-        else:
-            all_months = []
-        if not all_months:
-             selected_month = None
-        else:
-             selected_month = col1.selectbox("月份", options=all_months, index=0, key='month_selector', label_visibility="collapsed")
+        selected_month = col1.selectbox("月份", options=all_months, index=0, key='month_selector', label_visibility="collapsed", on_change=reset_records_pages)
     
     # [Col 2] 類型篩選
     type_filter = col2.selectbox("類型", options=['全部', '收入', '支出'], key='type_filter', label_visibility="collapsed")
@@ -1097,11 +1626,9 @@ def display_records_list(db, user_id, df_records):
                     if not all(col in df_import.columns for col in required_cols):
                         st.error("❌ 格式錯誤：缺必要欄位")
                     else:
-                        success_count = 0
-                        updated_accounts = bank_accounts.copy()
-                        
                         with st.spinner("匯入中..."):
-                            for _, row in df_import.iterrows():
+                            import_records = []
+                            for row in df_import.to_dict("records"): # 純 dict，避免 iterrows 每列建立 Series
                                 try:
                                     r_date = pd.to_datetime(row['日期']).date()
                                     r_type = row['類型']
@@ -1118,7 +1645,6 @@ def display_records_list(db, user_id, df_records):
                                         else:
                                             final_acc_id = str(uuid.uuid4())
                                             name_to_id[r_pay_method] = final_acc_id
-                                            updated_accounts[final_acc_id] = {'name': r_pay_method, 'balance': 0}
 
                                     record_data = {
                                         'date': r_date,
@@ -1132,23 +1658,17 @@ def display_records_list(db, user_id, df_records):
                                         record_data['account_id'] = final_acc_id
                                         record_data['account_name'] = r_pay_method
 
-                                    add_record(db, user_id, record_data)
-
-                                    if final_acc_id:
-                                        acc_data = updated_accounts.get(final_acc_id, {'name': r_pay_method, 'balance': 0})
-                                        curr_bal = float(acc_data.get('balance', 0))
-                                        delta = r_amount * (-1.0 if r_type == '支出' else 1.0)
-                                        acc_data['balance'] = curr_bal + delta
-                                        updated_accounts[final_acc_id] = acc_data
-
-                                    success_count += 1
+                                    import_records.append(record_data)
                                 except:
                                     continue
+
+                            # 所有紀錄以批次 WriteBatch 並行寫入，而非逐筆 add_record；
+                            # 帳戶餘額在同一批次中以 Increment 調整 (新帳戶一併建立)，不再整份覆寫帳戶清單
+                            success_count = add_records(db, user_id, import_records)
                         
                         if success_count > 0:
-                            update_bank_accounts(db, user_id, updated_accounts)
                             st.success(f"已匯入 {success_count} 筆")
-                            st.cache_data.clear()
+                            clear_category_cache() # 紀錄/餘額/帳戶快取已由 add_records 清除
                             import time
                             time.sleep(1.0)
                             st.rerun()
@@ -1158,23 +1678,22 @@ def display_records_list(db, user_id, df_records):
 
     
     # --- 資料篩選 ---
-    df_filtered = df_records.copy()
+    # 只向 Firestore 查詢所選月份的紀錄
     if selected_month:
-        try:
-             selected_month_period = pd.Period(selected_month, freq='M')
-             if 'month_year_period' in df_filtered.columns:
-                 df_filtered = df_filtered.loc[df_filtered['month_year_period'] == selected_month_period].copy()
-             else:
-                 if 'date' in df_filtered.columns and pd.api.types.is_datetime64_any_dtype(df_filtered['date']):
-                     df_filtered['month_year_period'] = df_filtered['date'].dt.to_period('M')
-                     df_filtered = df_filtered.loc[df_filtered['month_year_period'] == selected_month_period].copy()
-        except: pass
+        month_start, month_end = month_bounds(selected_month)
+        records_limit = RECORDS_TABLE_LIMIT * st.session_state.get('records_pages', 1)
+        df_filtered = get_records_in_range(db, user_id, month_start, month_end, limit=records_limit)
+        # 以類型篩選前的筆數判斷是否達到查詢上限
+        reached_limit = len(df_filtered) >= records_limit
+    else:
+        df_filtered = pd.DataFrame(columns=RECORD_COLUMNS)
+        reached_limit = False
 
     if type_filter != '全部':
-        df_filtered = df_filtered.loc[df_filtered['type'] == type_filter].copy()
+        # 僅作讀取用途，布林篩選的結果即可直接使用，不需額外 .copy()
+        df_filtered = df_filtered.loc[df_filtered['type'] == type_filter]
 
-    if st.session_state.editing_record_id is None:
-        df_filtered = df_filtered.sort_values(by='date', ascending=False)
+    # 查詢已於伺服器端依 'date' 降序排列 (見 load_records_in_range)，不需再於本地排序
     
     # [Col 5] 下載歷史紀錄按鈕
     with col4:
@@ -1209,156 +1728,226 @@ def display_records_list(db, user_id, df_records):
         else:
             st.info("無紀錄")
 
-    # --- 紀錄列表標題 ---
-    header_cols = st.columns([1.2, 1, 1, 0.7, 7, 2]) 
-    headers = ['日期', '類別', '金額', '類型', '備註', '操作']
-    for col, header in zip(header_cols, headers):
-        col.markdown(f"**{header}**")
-
-    # --- 顯示與編輯紀錄 (維持原樣) ---
+    # --- 顯示與編輯紀錄 ---
     if df_filtered.empty:
         st.info("ℹ️ 無符合篩選條件的交易紀錄。")
-    else:
-        for index, row in df_filtered.iterrows():
-            try:
-                record_id = row['id']
-                record_date_obj = row.get('date') 
-                record_type = row.get('type', 'N/A')
-                record_category = row.get('category', 'N/A')
-                record_amount = safe_float(row.get('amount', 0)) 
-                record_note = row.get('note', 'N/A')
-                record_account_name = row.get('account_name')
-            except KeyError as e:
-                continue
-
-            # --- 編輯模式 ---
-            if record_id == st.session_state.get('editing_record_id'):
-                
-                def _safe_date_local(v):
-                    if isinstance(v, datetime.date): return v
-                    return safe_date(v)
+        return
+    if reached_limit:
+        limit_cols = st.columns([4, 1])
+        limit_cols[0].caption(f"⚠️ 本月紀錄較多，目前僅顯示 (及下載) 最新的 {records_limit} 筆。")
+        limit_cols[1].button("⬇️ 載入更多", use_container_width=True, key="btn_load_more_records", on_click=load_more_records)
+
+    # 編輯模式：在表格上方顯示正在編輯的紀錄表單
+    editing_id = st.session_state.get('editing_record_id')
+    if editing_id is not None:
+        editing_rows = df_filtered.loc[df_filtered['id'] == editing_id]
+        if not editing_rows.empty:
+            display_record_edit_form(db, user_id, editing_rows.iloc[0], name_to_id, base_payment_options)
+
+    # 以單一 st.dataframe 呈現整張表 (前端虛擬化捲動)，取代每筆紀錄一組 st.columns + 按鈕
+    display_df = build_records_table(df_filtered)
+    # 選取狀態以列位置儲存：表格 key 納入資料版本與月份/類型/分頁狀態，資料或篩選改變時選取隨之重設，
+    # 避免沿用的列位置指向使用者未選取的紀錄 (其他分頁寫入、版本遞增或「載入更多」之後)
+    try:
+        records_version = get_records_version(db, user_id) # 快取值，與上方查詢使用的版本相同
+    except Exception:
+        records_version = 0
+    table_key = "records_table_{}_{}_{}_{}_{}".format(
+        st.session_state.get('records_table_version', 0), selected_month, type_filter,
+        st.session_state.get('records_pages', 1), records_version
+    )
+    event = st.dataframe(
+        display_df,
+        column_config={
+            '日期': st.column_config.TextColumn('日期', width="small"),
+            '類別': st.column_config.TextColumn('類別', width="small"),
+            '金額': st.column_config.NumberColumn('金額', format="%+.0f", width="small"),
+            '類型': st.column_config.TextColumn('類型', width="small"),
+            '備註': st.column_config.TextColumn('備註', width="large"),
+        },
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=table_key,
+    )
+
+    # 選取列後才顯示操作按鈕；動作在 on_click 回呼中執行 (早於下一次 rerun)
+    # 只取選取列的欄位 (display_df 與 df_filtered 列順序一致)，不需為每一列建立 tuple
+    selected_rows = df_filtered.iloc[event.selection.rows]
+    selected = list(zip(selected_rows['id'], selected_rows['type'], selected_rows['amount'], selected_rows['category'], selected_rows['date']))
+    if selected:
+        action_cols = st.columns([1, 1, 4])
+        action_cols[0].button(
+            "✏️ 編輯", use_container_width=True, key="btn_edit_selected_record",
+            disabled=len(selected) != 1, help="一次只能編輯一筆紀錄",
+            on_click=start_editing_record, args=(selected[0][0],)
+        )
+        action_cols[1].button(
+            f"🗑️ 刪除 ({len(selected)})", use_container_width=True, key="btn_delete_selected_records", type="secondary",
+            on_click=delete_selected_records, args=(db, user_id, selected)
+        )
+
+
+def load_more_records():
+    """「載入更多」按鈕回呼：下一次查詢多取一頁 (RECORDS_TABLE_LIMIT 筆)"""
+    st.session_state['records_pages'] = st.session_state.get('records_pages', 1) + 1
 
-                st.markdown(f"**正在編輯：** `{(record_note or '')[:20]}...`")
-                
-                edit_cols_1 = st.columns(3)
-                with edit_cols_1[0]:
-                    default_date = safe_date(record_date_obj)
-                    new_date = st.date_input("日期", value=_safe_date_local(default_date), key=f"edit_date_{record_id}")
-                with edit_cols_1[1]:
-                    new_type = st.radio("類型", ['支出', '收入'], index=0 if record_type == '支出' else 1, key=f"edit_type_{record_id}", horizontal=True)
-                with edit_cols_1[2]:
-                    new_amount = st.number_input("金額", min_value=0, value=safe_int(record_amount), step=1, format="%d", key=f"edit_amount_{record_id}")
-                
-                edit_cols_2 = st.columns([1.5, 1.5, 3]) 
-                
-                with edit_cols_2[0]:
-                    category_options = CATEGORIES.get(new_type, [])
-                    if new_type == '支出':
-                        try:
-                            all_db_categories = get_all_categories(db, user_id)
-                        except Exception:
-                            all_db_categories = []
-                        category_options = sorted(list(set((category_options or []) + (all_db_categories or []))))
-                    try:
-                        cat_index = category_options.index(record_category)
-                    except ValueError:
-                        if record_category:
-                            category_options = (category_options or []) + [record_category]
-                            cat_index = category_options.index(record_category)
-                        else:
-                            cat_index = 0
-                    new_category = st.selectbox("類別", options=category_options or ["未分類"], index=min(cat_index, max(len(category_options)-1, 0)), key=f"edit_cat_{record_id}")
-
-                with edit_cols_2[1]:
-                    current_options = list(base_payment_options)
-                    if record_account_name and record_account_name not in current_options:
-                        current_options.append(record_account_name)
-                    
-                    pay_index = None
-                    if record_account_name in current_options:
-                        pay_index = current_options.index(record_account_name)
-
-                    new_payment_method = st.selectbox(
-                        "支付方式",
-                        options=current_options,
-                        index=pay_index, 
-                        placeholder="選填...",
-                        key=f"pay_select_{record_id}"
-                    )
-
-                with edit_cols_2[2]:
-                    new_note = st.text_area("備註", value=record_note or "", key=f"edit_note_{record_id}", height=60)
-                
-                btn_cols = st.columns([1,1,3])
-                save_clicked = btn_cols[0].button("💾 儲存", use_container_width=True, key=f"save_btn_{record_id}")
-                cancel_clicked = btn_cols[1].button("❌ 取消", use_container_width=True, key=f"cancel_btn_{record_id}")
-                
-                if cancel_clicked:
-                    st.session_state.editing_record_id = None
-                    st.rerun()
-                
-                if save_clicked:
-                    if new_amount is None or safe_int(new_amount) <= 0:
-                        st.warning("⚠️ 金額需為正整數")
-                    elif not isinstance(new_date, datetime.date):
-                        st.warning("⚠️ 日期格式不正確")
-                    elif not new_category:
-                        st.warning("⚠️ 請選擇/輸入類別")
-                    else:
-                        new_data = {
-                            'date': new_date,
-                            'type': new_type,
-                            'category': new_category,
-                            'amount': float(safe_int(new_amount)),
-                            'note': (new_note or "").strip() or "無備註",
-                        }
-                        
-                        if new_payment_method:
-                            acc_id = name_to_id.get(new_payment_method)
-                            if not acc_id:
-                                acc_id = str(uuid.uuid4())
-                            
-                            new_data['account_name'] = new_payment_method
-                            new_data['account_id'] = acc_id
-                        else:
-                            new_data['account_name'] = firestore.DELETE_FIELD
-                            new_data['account_id'] = firestore.DELETE_FIELD
-
-                        old_data = {'type': record_type, 'amount': record_amount}
-                        update_record(db, user_id, record_id, new_data, old_data)
-                        st.session_state.editing_record_id = None
-                        st.rerun()
 
+def reset_records_pages():
+    """切換月份時回到第一頁"""
+    st.session_state['records_pages'] = 1
+
+
+def reset_records_table_selection():
+    """更換表格 key 以清除選取狀態"""
+    st.session_state['records_table_version'] = st.session_state.get('records_table_version', 0) + 1
+
+
+def start_editing_record(record_id):
+    """「編輯」按鈕回呼：進入單筆紀錄編輯模式"""
+    st.session_state.editing_record_id = record_id
+    reset_records_table_selection()
+
+
+def stop_editing_record():
+    """「取消」按鈕回呼：離開編輯模式"""
+    st.session_state.editing_record_id = None
+
+
+def delete_selected_records(db, user_id, selected):
+    """
+    「刪除」按鈕回呼：刪除選取的紀錄
+    - 回呼在下一次 rerun 之前執行，因此刪除後的重跑只需讀取一次資料
+    - selected 為 (id, type, amount, category, date) 列表
+    """
+    if len(selected) == 1:
+        record_id, record_type, record_amount, record_category, record_date = selected[0]
+        delete_record(db, user_id, record_id, record_type, safe_float(record_amount), record_category, record_date)
+    else:
+        delete_records(db, user_id, selected)
+    reset_records_table_selection()
+
+
+def build_records_table(df_filtered: pd.DataFrame) -> pd.DataFrame:
+    """將篩選後的紀錄轉換為 st.dataframe 顯示用的 DataFrame (向量化)"""
+    is_income = df_filtered['type'] == '收入'
+    amount = pd.to_numeric(df_filtered['amount'], errors='coerce').fillna(0)
+    note = df_filtered['note'].fillna('').astype(str)
+    if 'account_name' in df_filtered.columns:
+        account_name = df_filtered['account_name']
+        has_account = account_name.notna() & (account_name.astype(str) != '')
+        note = note.where(~has_account, note + " (" + account_name.astype(str) + ")")
+
+    return pd.DataFrame({
+        '日期': pd.to_datetime(df_filtered['date'], errors='coerce').dt.strftime('%Y-%m-%d').fillna("Error"),
+        '類別': df_filtered['category'],
+        '金額': amount.where(is_income, -amount),
+        '類型': df_filtered['type'],
+        '備註': note,
+    }).reset_index(drop=True)
+
+
+def display_record_edit_form(db, user_id, row, name_to_id, base_payment_options):
+    """顯示單筆紀錄的編輯表單"""
+    record_id = row['id']
+    record_date_obj = row.get('date')
+    record_type = row.get('type', 'N/A')
+    record_category = row.get('category', 'N/A')
+    record_amount = safe_float(row.get('amount', 0))
+    record_note = row.get('note', 'N/A')
+    record_account_name = row.get('account_name')
+    if pd.isna(record_account_name):
+        record_account_name = None
+
+    def _safe_date_local(v):
+        if isinstance(v, datetime.date): return v
+        return safe_date(v)
+
+    st.markdown(f"**正在編輯：** `{(record_note or '')[:20]}...`")
+
+    edit_cols_1 = st.columns(3)
+    with edit_cols_1[0]:
+        default_date = safe_date(record_date_obj)
+        new_date = st.date_input("日期", value=_safe_date_local(default_date), key=f"edit_date_{record_id}")
+    with edit_cols_1[1]:
+        new_type = st.radio("類型", RECORD_TYPE_OPTIONS, index=0 if record_type == '支出' else 1, key=f"edit_type_{record_id}", horizontal=True)
+    with edit_cols_1[2]:
+        new_amount = st.number_input("金額", min_value=0, value=safe_int(record_amount), step=1, format="%d", key=f"edit_amount_{record_id}")
+
+    edit_cols_2 = st.columns([1.5, 1.5, 3])
+
+    with edit_cols_2[0]:
+        if new_type == '支出':
+            category_options = get_expense_category_options(db, user_id)
+        else:
+            category_options = CATEGORIES.get(new_type, ())
+        try:
+            cat_index = category_options.index(record_category)
+        except ValueError:
+            if record_category:
+                category_options = category_options + (record_category,)
+                cat_index = category_options.index(record_category)
             else:
-                if pd.isna(record_date_obj):
-                    record_date_str = f"Error"
-                else:
-                    try:
-                         record_date_str = safe_date(record_date_obj).strftime('%Y-%m-%d')
-                    except Exception:
-                         record_date_str = str(record_date_obj).split(' ')[0]
-
-                color = "#28a745" if record_type == '收入' else "#dc3545"
-                amount_sign = "+" if record_type == '收入' else "-"
-
-                with st.container(border=True):
-                    row_cols = st.columns([1.2, 1, 1, 0.7, 7, 2]) 
-                    row_cols[0].write(record_date_str)
-                    row_cols[1].write(record_category)
-                    row_cols[2].markdown(f"<span style='font-weight: bold; color: {color};'>{amount_sign} {record_amount:,.0f}</span>", unsafe_allow_html=True)
-                    row_cols[3].write(record_type)
-                    
-                    display_note = record_note
-                    if record_account_name:
-                         display_note += f" ({record_account_name})"
-                    row_cols[4].write(display_note)
+                cat_index = 0
+        new_category = st.selectbox("類別", options=category_options or ["未分類"], index=min(cat_index, max(len(category_options)-1, 0)), key=f"edit_cat_{record_id}")
+
+    with edit_cols_2[1]:
+        current_options = list(base_payment_options)
+        if record_account_name and record_account_name not in current_options:
+            current_options.append(record_account_name)
+
+        pay_index = None
+        if record_account_name in current_options:
+            pay_index = current_options.index(record_account_name)
+
+        new_payment_method = st.selectbox(
+            "支付方式",
+            options=current_options,
+            index=pay_index,
+            placeholder="選填...",
+            key=f"pay_select_{record_id}"
+        )
 
-                    if row_cols[5].button("✏️", key=f"edit_{record_id}", help="編輯"):
-                        st.session_state.editing_record_id = record_id
-                        st.rerun()
+    with edit_cols_2[2]:
+        new_note = st.text_area("備註", value=record_note or "", key=f"edit_note_{record_id}", height=60)
 
-                    if row_cols[5].button("🗑️", key=f"delete_{record_id}", type="secondary", help="刪除"):
-                        delete_record(db, user_id, record_id, record_type, record_amount)
+    btn_cols = st.columns([1,1,3])
+    save_clicked = btn_cols[0].button("💾 儲存", use_container_width=True, key=f"save_btn_{record_id}")
+    # 取消只需離開編輯模式：在回呼中處理，按鈕觸發的重跑即可反映，不需再 st.rerun()
+    btn_cols[1].button("❌ 取消", use_container_width=True, key=f"cancel_btn_{record_id}", on_click=stop_editing_record)
+
+    if save_clicked:
+        if new_amount is None or safe_int(new_amount) <= 0:
+            st.warning("⚠️ 金額需為正整數")
+        elif not isinstance(new_date, datetime.date):
+            st.warning("⚠️ 日期格式不正確")
+        elif not new_category:
+            st.warning("⚠️ 請選擇/輸入類別")
+        else:
+            new_data = {
+                'date': new_date,
+                'type': new_type,
+                'category': new_category,
+                'amount': float(safe_int(new_amount)),
+                'note': (new_note or "").strip() or "無備註",
+            }
+
+            if new_payment_method:
+                acc_id = name_to_id.get(new_payment_method)
+                if not acc_id:
+                    acc_id = str(uuid.uuid4())
+
+                new_data['account_name'] = new_payment_method
+                new_data['account_id'] = acc_id
+            else:
+                new_data['account_name'] = firestore.DELETE_FIELD
+                new_data['account_id'] = firestore.DELETE_FIELD
+
+            old_data = {'type': record_type, 'amount': record_amount, 'category': record_category, 'date': record_date_obj}
+            update_record(db, user_id, record_id, new_data, old_data)
+            st.session_state.editing_record_id = None
+            st.rerun()
 
 
 def display_balance_management(db, user_id, current_balance):
@@ -1478,6 +2067,7 @@ def display_bank_account_management(db, user_id):
 
 # --- 7. 主應用程式框架 (使用 st.tabs) ---
 
+@st.fragment # 元件互動只重跑此區塊，不重跑整個 app
 def display_quick_entry_on_home(db, user_id):
     """首頁的『快速記帳』：新增淡灰色示範提示 (Placeholder)"""
     
@@ -1491,23 +2081,20 @@ def display_quick_entry_on_home(db, user_id):
         with c_mid:
             if st.button("🧾 快速記帳", use_container_width=True, key="btn_show_quick_entry"):
                 st.session_state.show_quick_entry = True
-                st.rerun()
+                st.rerun(scope="fragment") # 只需重繪快速記帳區塊
         return
 
     # --- 準備數據 ---
-    CATEGORY_OPTIONS = ["食", "衣", "住", "行", "育樂", "其他"]
-    
     try:
         bank_accounts = load_bank_accounts(db, user_id)
     except:
         bank_accounts = {}
     
     name_to_id = {data.get('name'): aid for aid, data in bank_accounts.items() if isinstance(data, dict)}
-    default_methods = ['現金', '信用卡', '悠遊卡']
     existing_names = list(name_to_id.keys())
     
     # 🔴 修改 1: 移除 '(未選擇)'，直接準備純淨的選項列表，讓 placeholder 生效
-    payment_options = default_methods + sorted([n for n in existing_names if n not in default_methods])
+    payment_options = DEFAULT_PAYMENT_METHODS + sorted([n for n in existing_names if n not in DEFAULT_PAYMENT_METHODS])
 
     # --- 版面配置 ---
     row1 = st.columns([2, 2, 2, 2.5, 1.5])
@@ -1516,7 +2103,7 @@ def display_quick_entry_on_home(db, user_id):
         # 🔴 修改 2: index=None 讓框框變空，並加上 placeholder
         category = st.selectbox(
             "類別", 
-            options=CATEGORY_OPTIONS, 
+            options=QUICK_ENTRY_CATEGORIES, 
             index=None,  # 預設不選
             key='quick_entry_category', 
             label_visibility="collapsed", 
@@ -1556,7 +2143,7 @@ def display_quick_entry_on_home(db, user_id):
         save_clicked = st.button("新增", use_container_width=True, key="quick_entry_save")
         if st.button("取消", use_container_width=True, key="quick_entry_cancel"):
              st.session_state.show_quick_entry = False
-             st.rerun()
+             st.rerun(scope="fragment")
 
     # --- 儲存邏輯 ---
     if save_clicked:
@@ -1592,25 +2179,12 @@ def display_quick_entry_on_home(db, user_id):
             record_data['account_id'] = final_acc_id
             record_data['account_name'] = final_acc_name
 
-        add_record(db, user_id, record_data)
+        # 紀錄與帳戶扣款 (伺服器端 Increment) 在同一個 WriteBatch 中提交
+        if not add_record(db, user_id, record_data, final_acc_id, final_acc_name, -float(amt)):
+            return # 保留輸入內容與錯誤訊息
 
-        # 更新餘額
         if final_acc_id:
-            try:
-                ba = load_bank_accounts(db, user_id) or {}
-                if not isinstance(ba, dict): ba = {}
-                
-                acc_data = ba.get(final_acc_id, {'name': final_acc_name, 'balance': 0})
-                if 'name' not in acc_data: acc_data['name'] = final_acc_name
-                
-                current_bal = safe_float(acc_data.get('balance', 0))
-                new_bal = current_bal - float(amt)
-                
-                ba[final_acc_id] = {'name': final_acc_name, 'balance': new_bal}
-                update_bank_accounts(db, user_id, ba)
-                st.toast(f"已從 {final_acc_name} 扣款")
-            except Exception as e:
-                st.warning(f"餘額更新失敗: {e}")
+            st.toast(f"已從 {final_acc_name} 扣款")
         else:
             st.toast(f"✅ 已記帳：{category} NT$ {amt:,}")
 
@@ -1620,8 +2194,9 @@ def display_quick_entry_on_home(db, user_id):
         for k in keys_to_clear:
             if k in st.session_state: del st.session_state[k]
         
-        st.cache_data.clear()
-        st.rerun()
+        # add_record 已清除紀錄/餘額快取，不需清空全部快取 (含磁碟上的持久化快取)
+        clear_category_cache()
+        st.rerun(scope="app") # 已寫入資料：重跑整個 app 以更新儀表板
 
 
 
@@ -1635,8 +2210,26 @@ def app():
 
     # 初始化 Firestore 和用戶 ID
     db = get_firestore_client()
+    if db is None:
+        # 連線失敗時只在這裡停止一次，避免後續每個函數各自重複檢查與報錯
+        st.error("無法連線至 Firestore，請檢查憑證設定。")
+        st.stop()
     user_id = get_user_id()
 
+    # 一次性將舊版字串日期轉為 Timestamp (已完成時只讀取一份 meta 文件)
+    try:
+        migrated = migrate_legacy_record_dates(db, user_id)
+        if migrated:
+            st.toast(f"🔧 已轉換 {migrated} 筆舊版紀錄的日期格式")
+    except Exception as e:
+        st.warning(f"⚠️ 舊版紀錄日期轉換失敗，部分紀錄可能暫時不會顯示: {e}")
+    else:
+        # 日期轉換完成後，一次性回填舊資料月份的彙總 (之後讀取彙總不會再觸發任何寫入)
+        try:
+            backfill_monthly_aggregates(db, user_id)
+        except Exception as e:
+            st.warning(f"⚠️ 每月彙總建立失敗，儀表板數字可能暫時不完整: {e}")
+
     # # 側邊欄 (這段程式碼在您的版本中應該是註解掉的，保持原樣即可)
     # with st.sidebar:
     #     # 📌 您可以在這裡更換您的圖片 URL 或本地路徑
@@ -1672,8 +2265,7 @@ def app():
         st.markdown("---") 
         
         # (3) 在下方接著顯示 "交易紀錄" 的區塊
-        df_records = get_all_records(db, user_id) 
-        display_records_list(db, user_id, df_records)
+        display_records_list(db, user_id)
 
     # 📌 修正 #4: "帳戶管理" 移到 tab3
     with tab3: